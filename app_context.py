@@ -1,12 +1,16 @@
 import os
-import json
+import sys
+import asyncio
+import threading
+import copy
 from pathlib import Path
 from collections import deque
-from typing import Any, Dict, List, Optional
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
 
+import json_codec
 from mcp_logger import logger
 from session_manager import SessionManager
-from filelock import FileLock
 
 # --- 全局常量 ---
 BASE_DIR = Path(__file__).parent.resolve()
@@ -17,6 +21,12 @@ PERSONAS_FILE = DATA_DIR / "personas.json"
 PRODUCTS_FILE = DATA_DIR / "products.json"
 AGENTS_FILE = DATA_DIR / "agents.json"
 TEAMS_FILE = DATA_DIR / "teams.json"
+STORE_FILES = {
+    "agents": AGENTS_FILE,
+    "teams_config": TEAMS_FILE,
+    "personas": PERSONAS_FILE,
+    "products": PRODUCTS_FILE,
+}
 
 # --- 依赖库导入 ---
 try:
@@ -32,17 +42,89 @@ except ImportError:
     Agent, Team, DeepSeek, OpenAILike, ExaTools, ThinkingTools = (type(None),) * 6
 
 
+def _freeze(value: Any) -> Any:
+    """将 JSON 数据递归转换为可哈希、可比较的结构，用作配置指纹。"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _intern_keys(raw: Any) -> Any:
+    """
+    对从 JSON 加载的数据中的键做 sys.intern：顶层 key、每条记录的字段名以及团队的 members 列表。
+    JSON 解析出的字符串不会自动驻留，驻留后在字典查找与拓扑排序中的比较可以直接按指针判等。
+    """
+    if not isinstance(raw, dict):
+        return raw
+    interned = {}
+    for key, value in raw.items():
+        if isinstance(value, dict):
+            value = {sys.intern(k): v for k, v in value.items()}
+            members = value.get("members")
+            if isinstance(members, list):
+                value["members"] = [sys.intern(m) if isinstance(m, str) else m for m in members]
+        interned[sys.intern(key)] = value
+    return interned
+
+
+class Rollback(Exception):
+    """在 ApplicationContext.transaction() 中抛出，以撤销事务内的全部修改。"""
+
+
+class _LazyData:
+    """延迟加载的数据属性：首次读取时才从文件加载，结果缓存在实例的 `_<name>_cached` 上。"""
+    registry: List[str] = []
+
+    def __init__(self, path: Path, is_json: bool = True):
+        self.path = path
+        self.is_json = is_json
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.cache_attr = f"_{name}_cached"
+        _LazyData.registry.append(name)
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = getattr(instance, self.cache_attr, None)
+        if value is None:
+            value = instance._load_file(self.path, is_json=self.is_json)
+            setattr(instance, self.cache_attr, value)
+        return value
+
+    def __set__(self, instance, value):
+        setattr(instance, self.cache_attr, value)
+
+
 class ApplicationContext:
     """保存应用程序的状态，包括配置、团队以及所有知识库。"""
+    agents = _LazyData(AGENTS_FILE)
+    teams_config = _LazyData(TEAMS_FILE)
+    personas = _LazyData(PERSONAS_FILE)
+    products = _LazyData(PRODUCTS_FILE)
+    company_knowledge_base = _LazyData(KNOWLEDGE_BASE_FILE, is_json=False)
+
     def __init__(self):
         self.session_manager = SessionManager(SESSIONS_DIR)
-        self.agents: Dict[str, Any] = {}
-        self.teams_config: Dict[str, Any] = {}
         self.teams: Dict[str, Optional[Team]] = {}
-        self.personas: Dict[str, Any] = {}
-        self.products: Dict[str, Any] = {}
-        self.company_knowledge_base: str = ""
         self.factory: Optional[Dict[str, Any]] = None
+        # 拓扑排序结果缓存，键为 teams_config 中成员关系的指纹
+        self._sort_cache_key: Optional[int] = None
+        self._sorted_team_keys: List[str] = []
+        self._write_locks: Dict[Path, asyncio.Lock] = {}
+        self._dirty: Set[str] = set()
+        # Agent 实例缓存：(team_key, agent_key) -> (agent 配置指纹, Agent 实例)。
+        # 按团队区分，因为 Team 会在其成员 Agent 上记录所属团队的状态，实例不能跨团队共享。
+        self._agent_cache: Dict[Tuple[str, str], Tuple[Any, Agent]] = {}
+        self._agent_tools: Dict[str, List[Any]] = {}
+        self._in_transaction = False
+        self._transaction_stores: Tuple[str, ...] = ()
+        # 人物/产品渲染后的上下文片段缓存，在写入时更新，供 run_ai_team 直接复用
+        self.persona_contexts: Dict[str, str] = {}
+        self.product_contexts: Dict[str, str] = {}
         
         DATA_DIR.mkdir(parents=True, exist_ok=True)
         
@@ -54,21 +136,79 @@ class ApplicationContext:
         else:
             logger.warning("由于'agno'不可用，跳过AI功能初始化。")
 
+    def _write_payload(self, payload: bytes, file_path: Path):
+        """先写入同目录下的临时文件并 fsync，再通过 os.replace 原子替换目标文件。"""
+        tmp_path = file_path.with_suffix(f"{file_path.suffix}.tmp.{os.getpid()}.{threading.get_ident()}")
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
     def _save_data_to_file(self, data: Dict, file_path: Path):
-        lock_path = file_path.with_suffix(file_path.suffix + '.lock')
         try:
-            with FileLock(lock_path):
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=2, ensure_ascii=False)
+            self._write_payload(json_codec.dumps_pretty(data), file_path)
+            logger.info(f"数据已成功保存至 {file_path}")
+        except (IOError, TypeError) as e:
+            logger.error(f"数据保存至 {file_path} 失败，原因: {e}", exc_info=True)
+            raise
+
+    async def _save_data_to_file_async(self, data: Dict, file_path: Path):
+        """在事件循环线程中完成序列化（保证数据快照一致），再将阻塞的文件写入交给工作线程。"""
+        try:
+            payload = json_codec.dumps_pretty(data)
+            # 同一文件的写入按调用顺序串行，避免旧数据覆盖新数据
+            async with self._write_locks.setdefault(file_path, asyncio.Lock()):
+                await asyncio.to_thread(self._write_payload, payload, file_path)
             logger.info(f"数据已成功保存至 {file_path}")
         except (IOError, TypeError) as e:
             logger.error(f"数据保存至 {file_path} 失败，原因: {e}", exc_info=True)
             raise
     
-    def save_agents(self): self._save_data_to_file(self.agents, AGENTS_FILE)
-    def save_teams_config(self): self._save_data_to_file(self.teams_config, TEAMS_FILE)
-    def save_personas(self): self._save_data_to_file(self.personas, PERSONAS_FILE)
-    def save_products(self): self._save_data_to_file(self.products, PRODUCTS_FILE)
+    async def _save_store(self, name: str):
+        if self._in_transaction:
+            # 未声明的数据在出错时无法回滚，也不会被写入，内存与文件将不一致
+            if name not in self._transaction_stores:
+                raise ValueError(f"数据 '{name}' 未在 transaction() 中声明，无法在事务内保存。")
+            self._dirty.add(name)
+            return
+        await self._save_data_to_file_async(getattr(self, name), STORE_FILES[name])
+
+    async def save_agents(self): await self._save_store("agents")
+
+    async def save_teams_config(self):
+        self._sort_cache_key = None
+        await self._save_store("teams_config")
+
+    async def save_personas(self): await self._save_store("personas")
+    async def save_products(self): await self._save_store("products")
+
+    @asynccontextmanager
+    async def transaction(self, *stores: str) -> AsyncIterator[None]:
+        """
+        合并事务内的保存操作：事务内调用 save_* 只会标记数据为脏，正常退出时每个文件统一写入一次；
+        事务内抛出异常（包括 Rollback）时，恢复进入事务时的快照且不写入任何文件。
+        :param stores: 事务内会保存、出错时需要回滚的数据名，如 "teams_config"；保存未声明的数据会抛出 ValueError。
+        """
+        snapshots = {name: copy.deepcopy(getattr(self, name)) for name in stores}
+        self._in_transaction = True
+        self._transaction_stores = stores
+        try:
+            yield
+        except BaseException:
+            for name, snapshot in snapshots.items():
+                setattr(self, name, snapshot)
+            raise
+        finally:
+            self._in_transaction = False
+            self._transaction_stores = ()
+            dirty, self._dirty = self._dirty, set()
+        for name in dirty:
+            await self._save_data_to_file_async(getattr(self, name), STORE_FILES[name])
 
     def _load_file(self, path: Path, is_json: bool) -> Any:
         if not path.exists():
@@ -78,19 +218,20 @@ class ApplicationContext:
                 return {}
             return ""
         try:
-            with path.open('r', encoding='utf-8') as f:
-                return json.load(f) if is_json else f.read()
-        except (IOError, json.JSONDecodeError) as e:
+            if is_json:
+                return _intern_keys(json_codec.loads(path.read_bytes()))
+            # 以二进制读取后一次性解码，省去 TextIOWrapper 的逐块解码；
+            # 与 read_text 的通用换行模式保持一致，将 CRLF / CR 统一为 LF
+            return path.read_bytes().decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+        except (IOError, json_codec.JSONDecodeError) as e:
             logger.error(f"无法加载或解析文件 {path} , 原因: {e}", exc_info=True)
             return {} if is_json else ""
 
     def _load_all_knowledge(self):
-        self.agents = self._load_file(AGENTS_FILE, is_json=True)
-        self.teams_config = self._load_file(TEAMS_FILE, is_json=True)
-        self.personas = self._load_file(PERSONAS_FILE, is_json=True)
-        self.products = self._load_file(PRODUCTS_FILE, is_json=True)
-        self.company_knowledge_base = self._load_file(KNOWLEDGE_BASE_FILE, is_json=False)
-        logger.info("所有配置文件和数据文件已加载。")
+        """重置所有数据缓存，各文件会在首次访问对应属性时才被读取。"""
+        for name in _LazyData.registry:
+            setattr(self, f"_{name}_cached", None)
+        logger.info("配置文件和数据文件将在首次访问时加载。")
 
     def _initialize_factory(self) -> Optional[Dict[str, Any]]:
         provider = os.environ.get("LLM_PROVIDER", "deepseek").lower()
@@ -132,12 +273,20 @@ class ApplicationContext:
                     return None
             elif member_key in self.agents:
                 agent_config = self.agents[member_key]
-                tools = [self.factory["tool_map"][t] for t in agent_config.get("tools", []) if t in self.factory["tool_map"]]
-                agent = Agent(
-                    name=agent_config.get("name", member_key), role=agent_config["role"],
-                    description=agent_config["description"], tools=tools, model=self.factory["agent_model"],
-                    instructions=agent_config.get("instructions"), markdown=True, add_datetime_to_instructions=True,
-                )
+                cache_key = (team_key, member_key)
+                # 保存完整的冻结结构并按值比较，避免哈希碰撞时误用过期的实例
+                fingerprint = _freeze(agent_config)
+                cached = self._agent_cache.get(cache_key)
+                if cached and cached[0] == fingerprint:
+                    agent = cached[1]
+                else:
+                    tools = self._agent_tools.get(member_key, [])
+                    agent = Agent(
+                        name=agent_config.get("name", member_key), role=agent_config["role"],
+                        description=agent_config["description"], tools=tools, model=self.factory["agent_model"],
+                        instructions=agent_config.get("instructions"), markdown=True, add_datetime_to_instructions=True,
+                    )
+                    self._agent_cache[cache_key] = (fingerprint, agent)
                 members.append(agent)
             else:
                 logger.error(f"团队 '{team_key}' 的成员 '{member_key}' 未在 agents.json 或 teams.json 中定义。")
@@ -152,52 +301,109 @@ class ApplicationContext:
             success_criteria=team_config.get("success_criteria"), markdown=True, add_datetime_to_instructions=True
         )
 
-    def reinitialize_teams(self) -> bool:
+    def reinitialize_teams(self, only: Optional[Set[str]] = None) -> bool:
+        """
+        按拓扑顺序重建团队实例。
+        :param only: (可选) 需要重建的团队key集合，其余团队复用已有实例；为 None 时重建全部团队。
+        """
         if not self.factory:
             logger.warning("AI factory 未初始化，无法初始化团队。")
             return False
+        previous_teams = self.teams if only is not None else {}
         self.teams = {}
-        logger.info("正在根据最新配置重新初始化所有团队...")
+        if only is None:
+            logger.info("正在根据最新配置重新初始化所有团队...")
+        else:
+            logger.info(f"正在重新初始化受影响的团队: {sorted(only)}")
         if not self.teams_config:
             logger.info("未定义任何团队，跳过初始化。")
             return True
+        # 清除已删除的角色或团队所对应的 Agent 缓存
+        for cache_key in [k for k in self._agent_cache if k[0] not in self.teams_config or k[1] not in self.agents]:
+            del self._agent_cache[cache_key]
         try:
-            sorted_team_keys = self._topological_sort(self.teams_config)
+            sorted_team_keys = self._get_sorted_team_keys()
             logger.info(f"正确的团队初始化顺序: {sorted_team_keys}")
         except ValueError as e:
             logger.critical(f"由于依赖循环，无法初始化团队: {e}")
             return False
+        # 每个角色的工具列表只构建一次，供其所在的所有团队共用
+        tool_map = self.factory["tool_map"]
+        self._agent_tools = {
+            agent_key: [tool_map[t] for t in agent_config.get("tools", []) if t in tool_map]
+            for agent_key, agent_config in self.agents.items()
+        }
         for team_key in sorted_team_keys:
+            if only is not None and team_key not in only:
+                if team_key in previous_teams:
+                    self.teams[team_key] = previous_teams[team_key]
+                continue
             team_instance = self._create_team_instance(team_key)
             if team_instance:
                 self.teams[team_key] = team_instance
                 logger.info(f"团队 '{team_key}' 初始化成功.")
             else:
                 logger.error(f"团队 '{team_key}' 初始化失败。")
-        logger.info("所有团队已重新初始化。")
+        logger.info("所有团队已重新初始化。" if only is None else "受影响的团队已重新初始化。")
         return True
 
+    def _teams_depending_on(self, agent_key: str) -> Set[str]:
+        """返回直接包含该角色的团队，以及以这些团队为成员的所有上层团队。"""
+        dependents: Dict[str, List[str]] = {key: [] for key in self.teams_config}
+        affected = set()
+        for team_key, config in self.teams_config.items():
+            members = config.get("members", [])
+            if agent_key in members:
+                affected.add(team_key)
+            for member in members:
+                if member in dependents:
+                    dependents[member].append(team_key)
+        queue = deque(affected)
+        while queue:
+            for dependent_team_key in dependents[queue.popleft()]:
+                if dependent_team_key not in affected:
+                    affected.add(dependent_team_key)
+                    queue.append(dependent_team_key)
+        return affected
+
+    def _get_sorted_team_keys(self) -> List[str]:
+        """返回团队初始化顺序，成员关系未变化时复用上一次的拓扑排序结果。"""
+        key = hash(tuple((k, tuple(v.get("members", []))) for k, v in sorted(self.teams_config.items())))
+        if key != self._sort_cache_key:
+            self._sorted_team_keys = self._topological_sort(self.teams_config)
+            self._sort_cache_key = key
+        return self._sorted_team_keys
+
     def _topological_sort(self, team_configs: Dict[str, Any]) -> List[str]:
-        adj = {key: [] for key in team_configs}
-        in_degree = {key: 0 for key in team_configs}
-        for team_key, config in team_configs.items():
-            dependencies = {member for member in config.get("members", []) if member in team_configs}
-            in_degree[team_key] = len(dependencies)
-            for dep_key in dependencies:
-                adj[dep_key].append(team_key)
-        queue = deque([key for key, degree in in_degree.items() if degree == 0])
+        # 常见情况：没有任何团队以其他团队为成员，原顺序即为合法的初始化顺序
+        if not any(member in team_configs for config in team_configs.values() for member in config.get("members", [])):
+            return list(team_configs.keys())
+        keys = list(team_configs.keys())
+        key_to_idx = {key: idx for idx, key in enumerate(keys)}
+        adj: List[List[int]] = [[] for _ in keys]
+        in_degree = [0] * len(keys)
+        for idx, (team_key, config) in enumerate(team_configs.items()):
+            members = config.get("members", [])
+            if team_key in members:
+                raise ValueError(f"团队 '{team_key}' 将自身列为成员，形成自循环。")
+            # 使用集合去重，避免重复列出的成员让入度被重复计算
+            dependencies = {key_to_idx[member] for member in members if member in key_to_idx}
+            in_degree[idx] = len(dependencies)
+            for dep_idx in dependencies:
+                adj[dep_idx].append(idx)
+        queue = deque([idx for idx, degree in enumerate(in_degree) if degree == 0])
         sorted_list = []
         while queue:
-            current_team_key = queue.popleft()
-            sorted_list.append(current_team_key)
-            for dependent_team_key in adj[current_team_key]:
-                in_degree[dependent_team_key] -= 1
-                if in_degree[dependent_team_key] == 0:
-                    queue.append(dependent_team_key)
+            current_idx = queue.popleft()
+            sorted_list.append(keys[current_idx])
+            for dependent_idx in adj[current_idx]:
+                in_degree[dependent_idx] -= 1
+                if in_degree[dependent_idx] == 0:
+                    queue.append(dependent_idx)
         if len(sorted_list) == len(team_configs):
             return sorted_list
         else:
-            cycle_nodes = {key for key, degree in in_degree.items() if degree > 0}
+            cycle_nodes = {keys[idx] for idx, degree in enumerate(in_degree) if degree > 0}
             raise ValueError(f"在团队依赖关系中检测到一个循环，涉及: {cycle_nodes}")
 
     def get_running_team(self, team_key: str) -> Optional[Team]:
@@ -0,0 +1,36 @@
+"""
+统一的 JSON 编解码工具：优先使用 orjson（C 实现，直接输出 UTF-8 字节），未安装时回退到标准库 json。
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    orjson = None
+    ORJSON_AVAILABLE = False
+
+# orjson.JSONDecodeError 是 json.JSONDecodeError 的子类，两种实现下捕获该异常即可
+JSONDecodeError = json.JSONDecodeError
+
+
+def loads(data: Union[bytes, memoryview, str]) -> Any:
+    """解析 JSON 字节串或字符串（memoryview 仅在使用 orjson 时支持）。"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> str:
+    """序列化为紧凑格式的 JSON 字符串（非 ASCII 字符不转义），用于返回给 MCP 客户端。"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def dumps_pretty(obj: Any) -> bytes:
+    """序列化为缩进两格的 UTF-8 JSON 字节串，用于写入便于人工编辑的数据文件。"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
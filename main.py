@@ -3,13 +3,14 @@
 Unified MCP
 """
 import sys
-import json
+import asyncio
 from contextlib import asynccontextmanager
 from typing import Any, AsyncIterator, Dict, List, Optional
 
 # 从新文件中导入核心组件
+import json_codec
 from mcp_logger import logger
-from app_context import app, AGNO_AVAILABLE
+from app_context import app, AGNO_AVAILABLE, Rollback
 from mcp.server.fastmcp import FastMCP
 
 # --- 全局常量 ---
@@ -18,33 +19,68 @@ mcp = FastMCP("Unified MCP")
 # 各信息 schema 与 必备字段定义
 # 人物类
 persona_schema = {"name": str, "role": str, "goals": list, "background": str}
-persona_required_fields = {"name", "role", "goals"}
+persona_required_fields = frozenset({"name", "role", "goals"})
 
 # 产品类
 product_schema = {"product_name": str, "description": str, "knowledge_base": str}
-product_required_fields = {"product_name", "description", "knowledge_base"}
+product_required_fields = frozenset({"product_name", "description", "knowledge_base"})
 
 # Agent角色类
 agent_schema = {"name": str, "role": str, "description": str, "tools": list, "instructions": str}
-agent_required_fields = {"name", "role", "description"}
+agent_required_fields = frozenset({"name", "role", "description"})
 
 # 团队类
 team_schema = {"team_name": str, "description": str, "members": list, "instructions": str, "success_criteria": str}
-team_required_fields = {"team_name", "members"}
+team_required_fields = frozenset({"team_name", "members"})
+
+# 预先计算的允许字段集合与 (字段, 类型) 元组，避免每次调用时重复构造
+persona_allowed, persona_types = frozenset(persona_schema), tuple(persona_schema.items())
+product_allowed, product_types = frozenset(product_schema), tuple(product_schema.items())
+agent_allowed, agent_types = frozenset(agent_schema), tuple(agent_schema.items())
+team_allowed, team_types = frozenset(team_schema), tuple(team_schema.items())
+
+_MISSING = object()
 
 # ==============================================
 # 辅助工具
 # ==============================================
-def validate_data(data: dict, schema: dict, required_fields: set) -> Optional[str]:
+def _dump(obj: Any) -> str:
+    """序列化返回给 MCP 客户端的数据，使用紧凑格式以减少体积与序列化开销。"""
+    return json_codec.dumps(obj)
+
+def _check_types(data: dict, schema_types: tuple) -> Optional[str]:
+    for key, expected_type in schema_types:
+        value = data.get(key, _MISSING)
+        if value is _MISSING:
+            continue
+        if type(value) is not expected_type:
+            return f"字段 '{key}' 的类型错误，应为 {expected_type.__name__}，但收到了 {type(value).__name__}。"
+    return None
+
+def validate_data(data: dict, schema_types: tuple, required_fields: frozenset) -> Optional[str]:
     """根据 schema 和必需字段校验数据。如果无效则返回错误信息字符串。"""
-    missing_fields = required_fields - set(data.keys())
+    missing_fields = required_fields - data.keys()
     if missing_fields:
         return f"缺少必需字段: {list(missing_fields)}"
-    
-    for key, value in data.items():
-        if key in schema and not isinstance(value, schema[key]):
-            return f"字段 '{key}' 的类型错误，应为 {schema[key].__name__}，但收到了 {type(value).__name__}。"
-    return None
+    return _check_types(data, schema_types)
+
+def validate_update(data: dict, allowed_fields: frozenset, schema_types: tuple) -> Optional[str]:
+    """校验部分更新的数据：只允许 schema 中的字段，且类型必须正确。如果无效则返回错误信息字符串。"""
+    for key in data:
+        if key not in allowed_fields:
+            return f"无效字段 '{key}'。允许的字段为: {[field for field, _ in schema_types]}"
+    return _check_types(data, schema_types)
+
+def render_persona_context(persona_key: str, persona_data: dict) -> str:
+    """渲染 run_ai_team 中使用的人物画像上下文片段。"""
+    profile_text = (f"Role: {persona_data.get('role')}\n"
+                    f"Goals: {', '.join(persona_data.get('goals',[]))}\n"
+                    f"Background: {persona_data.get('background', 'N/A')}")
+    return f"## Persona Profile to Embody: {persona_data.get('name', persona_key)}\n{profile_text}"
+
+def render_product_context(product_data: dict) -> str:
+    """渲染 run_ai_team 中使用的产品知识库上下文片段。"""
+    return f"## Knowledge Base for Product: '{product_data.get('product_name')}'\n{product_data.get('knowledge_base','')}"
 
 # ==============================================
 # MCP Tools
@@ -55,33 +91,39 @@ def start_session(initial_context: Optional[str] = None) -> str:
     """创建新的session用于存储和跟踪会话，每个会议或讨论都应该创建一个新的session。"""
     try:
         new_session = app.session_manager.create_session(initial_context=initial_context)
-        return json.dumps({
+        return _dump({
             "message": "新session创建成功.",
             "session_id": new_session["session_id"]
-        }, indent=2, ensure_ascii=False)
+        })
     except Exception as e:
         logger.error(f"创建session失败，错误信息: {e}", exc_info=True)
-        return json.dumps({"error": f"创建session失败，错误信息: {e}"})
+        return _dump({"error": f"创建session失败，错误信息: {e}"})
 
 # 人物类 mcp 组件
 @mcp.tool()
-def create_persona(persona_key: str, data: dict) -> str:
+async def create_persona(persona_key: str, data: dict) -> str:
     """
     根据定义的Schema创建一个新的人物。
     必需字段: 'name'(str), 'role'(str), 'goals'(list of str).
     可选字段: 'background'(str).
     """
     if persona_key in app.personas:
-        return json.dumps({"error": f"人物 '{persona_key}' 已存在..."})
+        return _dump({"error": f"人物 '{persona_key}' 已存在..."})
     
     # 使用统一的校验函数
-    error_msg = validate_data(data, persona_schema, persona_required_fields)
+    error_msg = validate_data(data, persona_types, persona_required_fields)
     if error_msg:
-        return json.dumps({"error": f"创建人物失败，{error_msg}"})
+        return _dump({"error": f"创建人物失败，{error_msg}"})
     
+    # 先渲染上下文再修改内存数据，渲染失败时不留下未保存的半成品
+    try:
+        context = render_persona_context(persona_key, data)
+    except TypeError as e:
+        return _dump({"error": f"创建人物失败，'goals' 必须是字符串列表: {e}"})
     app.personas[persona_key] = data
-    app.save_personas()
-    return json.dumps({"status": "success", "message": f"人物 '{persona_key}' 创建成功。"}, ensure_ascii=False)
+    app.persona_contexts[persona_key] = context
+    await app.save_personas()
+    return _dump({"status": "success", "message": f"人物 '{persona_key}' 创建成功。"})
 
 @mcp.tool()
 def list_personas() -> str:
@@ -90,7 +132,7 @@ def list_personas() -> str:
     """
     try:
         if not app.personas:
-            return json.dumps({"message": "目前尚未记录任何人物信息。"}, indent=2, ensure_ascii=False)
+            return _dump({"message": "目前尚未记录任何人物信息。"})
 
         persona_list = [
             {
@@ -103,206 +145,213 @@ def list_personas() -> str:
             for key, data in app.personas.items()
         ]
         
-        return json.dumps(persona_list, indent=2, ensure_ascii=False)
+        return _dump(persona_list)
     except Exception as e:
         logger.error(f"Failed to list personas: {e}", exc_info=True)
-        return json.dumps({"error": "An unexpected error occurred while listing personas."})
+        return _dump({"error": "An unexpected error occurred while listing personas."})
 
 @mcp.tool()
 def get_persona(persona_key: str) -> str:
     """获取指定人物的完整详细信息。"""
     persona_data = app.personas.get(persona_key)
     if not persona_data:
-        return json.dumps({"error": f"未找到人物 '{persona_key}'。"})
-    return json.dumps(persona_data, indent=2, ensure_ascii=False)
+        return _dump({"error": f"未找到人物 '{persona_key}'。"})
+    return _dump(persona_data)
 
 @mcp.tool()
-def update_persona(persona_key: str, data: dict) -> str:
+async def update_persona(persona_key: str, data: dict) -> str:
     """
     更新一个已存在人物的部分或全部信息。只提供需要修改的字段。
     """
     if persona_key not in app.personas:
-        return json.dumps({"error": f"未找到人物 '{persona_key}'，无法更新。"})
+        return _dump({"error": f"未找到人物 '{persona_key}'，无法更新。"})
     
     # 校验传入字段的合法性
-    for key, value in data.items():
-        if key not in persona_schema:
-            return json.dumps({"error": f"无效字段 '{key}'。允许的字段为: {list(persona_schema.keys())}"})
-        # 简单类型校验
-        if not isinstance(value, persona_schema[key]):
-            return json.dumps({"error": f"字段 '{key}' 的类型错误，应为 {persona_schema[key].__name__}，但收到了 {type(value).__name__}。"})
+    error_msg = validate_update(data, persona_allowed, persona_types)
+    if error_msg:
+        return _dump({"error": error_msg})
 
+    try:
+        context = render_persona_context(persona_key, {**app.personas[persona_key], **data})
+    except TypeError as e:
+        return _dump({"error": f"更新人物失败，'goals' 必须是字符串列表: {e}"})
     app.personas[persona_key].update(data)
-    app.save_personas()
-    return json.dumps({"status": "success", "message": f"人物 '{persona_key}' 更新成功。"}, ensure_ascii=False)
+    app.persona_contexts[persona_key] = context
+    await app.save_personas()
+    return _dump({"status": "success", "message": f"人物 '{persona_key}' 更新成功。"})
 
 @mcp.tool()
-def delete_persona(persona_key: str) -> str:
+async def delete_persona(persona_key: str) -> str:
     """删除一个指定的人物记录。"""
     if persona_key not in app.personas:
-        return json.dumps({"error": f"未找到人物 '{persona_key}'，无法删除。"})
+        return _dump({"error": f"未找到人物 '{persona_key}'，无法删除。"})
     
     del app.personas[persona_key]
-    app.save_personas()
-    return json.dumps({"status": "success", "message": f"人物 '{persona_key}' 删除成功。"}, ensure_ascii=False)
+    app.persona_contexts.pop(persona_key, None)
+    await app.save_personas()
+    return _dump({"status": "success", "message": f"人物 '{persona_key}' 删除成功。"})
 
 # 产品类 mcp 组件
 
 @mcp.tool()
-def create_product(product_key: str, data: dict) -> str:
+async def create_product(product_key: str, data: dict) -> str:
     """
     根据定义的Schema创建一个新产品。
     必需字段: 'product_name'(str), 'description'(str), 'knowledge_base'(str).
     """
     if product_key in app.products:
-        return json.dumps({"error": f"产品 '{product_key}' 已存在，请使用 update_product 进行更新。"})
+        return _dump({"error": f"产品 '{product_key}' 已存在，请使用 update_product 进行更新。"})
     
-    missing_fields = product_required_fields - set(data.keys())
+    missing_fields = product_required_fields - data.keys()
     if missing_fields:
-        return json.dumps({"error": f"创建产品失败，缺少必需字段: {list(missing_fields)}"})
+        return _dump({"error": f"创建产品失败，缺少必需字段: {list(missing_fields)}"})
     
     app.products[product_key] = data
-    app.save_products()
-    return json.dumps({"status": "success", "message": f"产品 '{product_key}' 创建成功。"}, ensure_ascii=False)
+    app.product_contexts[product_key] = render_product_context(data)
+    await app.save_products()
+    return _dump({"status": "success", "message": f"产品 '{product_key}' 创建成功。"})
 
 @mcp.tool()
 def list_products() -> str:
     """列出所有已记录的产品。"""
     if not app.products:
-        return json.dumps({"message": "目前尚未记录任何产品。"}, indent=2, ensure_ascii=False)
+        return _dump({"message": "目前尚未记录任何产品。"})
     product_list = [
         {"product_key": key, "product_name": data.get("product_name", "N/A"), "description": data.get("description", "")}
         for key, data in app.products.items()
     ]
-    return json.dumps(product_list, indent=2, ensure_ascii=False)
+    return _dump(product_list)
 
 @mcp.tool()
 def get_product(product_key: str) -> str:
     """获取指定产品的完整详细信息，包括其知识库。"""
     product_data = app.products.get(product_key)
     if not product_data:
-        return json.dumps({"error": f"未找到产品 '{product_key}'。"})
-    return json.dumps(product_data, indent=2, ensure_ascii=False)
+        return _dump({"error": f"未找到产品 '{product_key}'。"})
+    return _dump(product_data)
 
 @mcp.tool()
-def update_product(product_key: str, data: dict) -> str:
+async def update_product(product_key: str, data: dict) -> str:
     """更新一个已存在产品的信息。只提供需要修改的字段。"""
     if product_key not in app.products:
-        return json.dumps({"error": f"未找到产品 '{product_key}'，无法更新。"})
-
-    for key, value in data.items():
-        if key not in product_schema:
-            return json.dumps({"error": f"无效字段 '{key}'。允许的字段为: {list(product_schema.keys())}"})
-        if not isinstance(value, product_schema[key]):
-            return json.dumps({"error": f"字段 '{key}' 的类型错误，应为 {product_schema[key].__name__}。"})
-            
+        return _dump({"error": f"未找到产品 '{product_key}'，无法更新。"})
+
+    error_msg = validate_update(data, product_allowed, product_types)
+    if error_msg:
+        return _dump({"error": error_msg})
+
     app.products[product_key].update(data)
-    app.save_products()
-    return json.dumps({"status": "success", "message": f"产品 '{product_key}' 更新成功。"}, ensure_ascii=False)
+    app.product_contexts[product_key] = render_product_context(app.products[product_key])
+    await app.save_products()
+    return _dump({"status": "success", "message": f"产品 '{product_key}' 更新成功。"})
 
 @mcp.tool()
-def delete_product(product_key: str) -> str:
+async def delete_product(product_key: str) -> str:
     """删除一个指定的产品记录及其知识库。"""
     if product_key not in app.products:
-        return json.dumps({"error": f"未找到产品 '{product_key}'，无法删除。"})
+        return _dump({"error": f"未找到产品 '{product_key}'，无法删除。"})
     
     del app.products[product_key]
-    app.save_products()
-    return json.dumps({"status": "success", "message": f"产品 '{product_key}' 删除成功。"}, ensure_ascii=False)
+    app.product_contexts.pop(product_key, None)
+    await app.save_products()
+    return _dump({"status": "success", "message": f"产品 '{product_key}' 删除成功。"})
 
 # 人物Agent与团队类 mcp 组件
 
 @mcp.tool()
-def create_agent(agent_key: str, data: dict) -> str:
+async def create_agent(agent_key: str, data: dict) -> str:
     """
     创建一个新的角色(Agent)。
     必需字段: 'name'(str), 'role'(str), 'description'(str).
     可选字段: 'tools'(list of str), 'instructions'(str).
     """
     if agent_key in app.agents:
-        return json.dumps({"error": f"角色 '{agent_key}' 已存在。"})
-    missing = agent_required_fields - set(data.keys())
+        return _dump({"error": f"角色 '{agent_key}' 已存在。"})
+    missing = agent_required_fields - data.keys()
     if missing:
-        return json.dumps({"error": f"缺少必需字段: {list(missing)}"})
+        return _dump({"error": f"缺少必需字段: {list(missing)}"})
     
     app.agents[agent_key] = data
-    app.save_agents()
-    app.reinitialize_teams() # 重新构建团队以识别新角色
-    return json.dumps({"status": "success", "message": f"角色 '{agent_key}' 创建成功。团队已重新初始化。"}, ensure_ascii=False)
+    await app.save_agents()
+    app.reinitialize_teams(only=app._teams_depending_on(agent_key)) # 重新构建团队以识别新角色
+    return _dump({"status": "success", "message": f"角色 '{agent_key}' 创建成功。团队已重新初始化。"})
 
 @mcp.tool()
 def get_agent(agent_key: str) -> str:
     """获取指定角色的配置信息。"""
     agent_data = app.agents.get(agent_key)
     if not agent_data:
-        return json.dumps({"error": f"未找到角色 '{agent_key}'。"})
-    return json.dumps(agent_data, indent=2, ensure_ascii=False)
+        return _dump({"error": f"未找到角色 '{agent_key}'。"})
+    return _dump(agent_data)
 
 @mcp.tool()
 def list_agents() -> str:
     """列出所有已定义的角色(Agent)。"""
     if not app.agents:
-        return json.dumps({"message": "尚未定义任何角色。"}, indent=2, ensure_ascii=False)
-    return json.dumps([{"agent_key": k, "name": v.get("name"), "role": v.get("role")} for k, v in app.agents.items()], indent=2, ensure_ascii=False)
+        return _dump({"message": "尚未定义任何角色。"})
+    return _dump([{"agent_key": k, "name": v.get("name"), "role": v.get("role")} for k, v in app.agents.items()])
 
 @mcp.tool()
-def update_agent(agent_key: str, data: dict) -> str:
+async def update_agent(agent_key: str, data: dict) -> str:
     """更新一个已存在角色的信息。"""
     if agent_key not in app.agents:
-        return json.dumps({"error": f"未找到角色 '{agent_key}'。"})
+        return _dump({"error": f"未找到角色 '{agent_key}'。"})
     
     app.agents[agent_key].update(data)
-    app.save_agents()
-    app.reinitialize_teams() # 角色更新可能影响团队
-    return json.dumps({"status": "success", "message": f"角色 '{agent_key}' 更新成功。团队已重新初始化。"}, ensure_ascii=False)
+    await app.save_agents()
+    app.reinitialize_teams(only=app._teams_depending_on(agent_key)) # 角色更新可能影响团队
+    return _dump({"status": "success", "message": f"角色 '{agent_key}' 更新成功。团队已重新初始化。"})
 
 @mcp.tool()
-def delete_agent(agent_key: str) -> str:
+async def delete_agent(agent_key: str) -> str:
     """删除一个角色(Agent)。警告：这可能导致依赖此角色的团队失效。"""
     if agent_key not in app.agents:
-        return json.dumps({"error": f"未找到角色 '{agent_key}'。"})
+        return _dump({"error": f"未找到角色 '{agent_key}'。"})
     
     del app.agents[agent_key]
-    app.save_agents()
-    app.reinitialize_teams() # 角色删除必须重载团队
-    return json.dumps({"status": "success", "message": f"角色 '{agent_key}' 已删除。团队已重新初始化。"}, ensure_ascii=False)
+    await app.save_agents()
+    app.reinitialize_teams(only=app._teams_depending_on(agent_key)) # 角色删除必须重载团队
+    return _dump({"status": "success", "message": f"角色 '{agent_key}' 已删除。团队已重新初始化。"})
 
 @mcp.tool()
-def create_team(team_key: str, data: dict) -> str:
+async def create_team(team_key: str, data: dict) -> str:
     """
     创建一个新的团队。
     必需字段: 'team_name'(str), 'members'(list of str, 成员key可以是agent或team).
     可选字段: 'description'(str), 'instructions'(str), 'success_criteria'(str).
     """
     if team_key in app.teams_config:
-        return json.dumps({"error": f"团队 '{team_key}' 已存在。"})
-    missing = team_required_fields - set(data.keys())
+        return _dump({"error": f"团队 '{team_key}' 已存在。"})
+    missing = team_required_fields - data.keys()
     if missing:
-        return json.dumps({"error": f"缺少必需字段: {list(missing)}"})
+        return _dump({"error": f"缺少必需字段: {list(missing)}"})
     
-    app.teams_config[team_key] = data
-    app.save_teams_config()
-    if not app.reinitialize_teams():
-        # 如果重载失败（比如有循环依赖），则撤销操作
-        del app.teams_config[team_key]
-        app.save_teams_config()
-        return json.dumps({"error": "团队创建失败，可能是因为引入了循环依赖或无效成员。操作已回滚。"})
+    try:
+        async with app.transaction("teams_config"):
+            app.teams_config[team_key] = data
+            await app.save_teams_config()
+            if not app.reinitialize_teams():
+                # 如果重载失败（比如有循环依赖），则撤销操作
+                raise Rollback
+    except Rollback:
+        app.reinitialize_teams()
+        return _dump({"error": "团队创建失败，可能是因为引入了循环依赖或无效成员。操作已回滚。"})
         
-    return json.dumps({"status": "success", "message": f"团队 '{team_key}' 创建成功并已激活。"}, ensure_ascii=False)
+    return _dump({"status": "success", "message": f"团队 '{team_key}' 创建成功并已激活。"})
 
 @mcp.tool()
 def get_team_config(team_key: str) -> str:
     """获取指定团队的配置信息（非运行实例）。"""
     team_data = app.teams_config.get(team_key)
     if not team_data:
-        return json.dumps({"error": f"未找到团队配置 '{team_key}'。"})
-    return json.dumps(team_data, indent=2, ensure_ascii=False)
+        return _dump({"error": f"未找到团队配置 '{team_key}'。"})
+    return _dump(team_data)
 
 @mcp.tool()
 def list_teams() -> str:
     """列出所有已配置的团队。"""
     if not app.teams_config:
-        return json.dumps({"message": "尚未配置任何团队。"}, indent=2, ensure_ascii=False)
+        return _dump({"message": "尚未配置任何团队。"})
     
     team_list = []
     for key, config in app.teams_config.items():
@@ -312,36 +361,36 @@ def list_teams() -> str:
             "team_name": config.get("team_name"),
             "status": "active" if is_active else "inactive (config error)，请检查成员或环境参数设置，特别是exa_api_key参数不能缺少",
         })
-    return json.dumps(team_list, indent=2, ensure_ascii=False)
+    return _dump(team_list)
 
 @mcp.tool()
-def update_team(team_key: str, data: dict) -> str:
+async def update_team(team_key: str, data: dict) -> str:
     """更新一个已存在团队的配置。"""
     if team_key not in app.teams_config:
-        return json.dumps({"error": f"未找到团队配置 '{team_key}'。"})
+        return _dump({"error": f"未找到团队配置 '{team_key}'。"})
     
-    original_config = app.teams_config[team_key].copy()
-    app.teams_config[team_key].update(data)
-    app.save_teams_config()
-    if not app.reinitialize_teams():
-        app.teams_config[team_key] = original_config
-        app.save_teams_config()
+    try:
+        async with app.transaction("teams_config"):
+            app.teams_config[team_key].update(data)
+            await app.save_teams_config()
+            if not app.reinitialize_teams():
+                raise Rollback
+    except Rollback:
         app.reinitialize_teams()
-        return json.dumps({"error": "团队更新失败，新配置可能导致错误。操作已回滚。"})
+        return _dump({"error": "团队更新失败，新配置可能导致错误。操作已回滚。"})
 
-    app.save_teams_config()
-    return json.dumps({"status": "success", "message": f"团队 '{team_key}' 更新成功并已重新激活。"}, ensure_ascii=False)
+    return _dump({"status": "success", "message": f"团队 '{team_key}' 更新成功并已重新激活。"})
 
 @mcp.tool()
-def delete_team(team_key: str) -> str:
+async def delete_team(team_key: str) -> str:
     """删除一个团队的配置。"""
     if team_key not in app.teams_config:
-        return json.dumps({"error": f"未找到团队配置 '{team_key}'。"})
+        return _dump({"error": f"未找到团队配置 '{team_key}'。"})
     
     del app.teams_config[team_key]
-    app.save_teams_config()
+    await app.save_teams_config()
     app.reinitialize_teams() # 团队删除后必须重载
-    return json.dumps({"status": "success", "message": f"团队 '{team_key}' 已删除。"}, ensure_ascii=False)
+    return _dump({"status": "success", "message": f"团队 '{team_key}' 已删除。"})
 
 # 团队讨论类 mcp 组件
 @mcp.tool()
@@ -355,41 +404,59 @@ async def run_ai_team(team_name: str, prompt: str, session_id: Optional[str] = N
     :param product_key: (可选) 本次任务关联的产品的key，用于加载特定知识库。
     """
     if not AGNO_AVAILABLE or not app.factory:
-        return json.dumps({"error": "程序未正常安装运行库，AI 无法使用."})
+        return _dump({"error": "程序未正常安装运行库，AI 无法使用."})
 
     team = app.get_running_team(team_name) # MODIFIED: 使用新的getter
     if not team:
-        return json.dumps({"error": f"团队 ‘{team_name}’ 不可用或初始化失败。请检查团队配置和依赖关系。"})
+        return _dump({"error": f"团队 ‘{team_name}’ 不可用或初始化失败。请检查团队配置和依赖关系。"})
 
 
-    context_parts = []
+    # 立即将会话读取提交到工作线程，与下方的上下文拼装并行进行
+    # (run_in_executor 会立刻提交任务；create_task 则要等到当前协程让出控制权后才会开始执行)
+    session_task = asyncio.get_running_loop().run_in_executor(None, app.session_manager.load_session, session_id) if session_id else None
+
+    # 各段落按 "标题, 正文, 分隔符" 平铺追加，最后通过一次 str.join 拼装完整提示词
+    parts: List[str] = []
     session_data = None
-    
-    if session_id:
-        session_data = app.session_manager.load_session(session_id)
+
+    if app.company_knowledge_base:
+        parts.append("## Company-Wide Knowledge Base\n")
+        parts.append(app.company_knowledge_base)
+        parts.append("\n\n")
+    if product_key: # MODIFIED: 使用product_key
+        product_context = app.product_contexts.get(product_key)
+        if product_context is None:
+            product_data = app.products.get(product_key)
+            if product_data:
+                product_context = app.product_contexts[product_key] = render_product_context(product_data)
+        if product_context:
+            parts.append(product_context)
+            parts.append("\n\n")
+    if persona_key: # MODIFIED: 使用persona_key
+        persona_context = app.persona_contexts.get(persona_key)
+        if persona_context is None:
+            persona_data = app.personas.get(persona_key)
+            if persona_data:
+                persona_context = app.persona_contexts[persona_key] = render_persona_context(persona_key, persona_data)
+        if persona_context:
+            parts.append(persona_context)
+            parts.append("\n\n")
+
+    if session_task:
+        session_data = await session_task
         if session_data:
             history_str = "\n".join([f"Previous {entry['role']}: {entry['content']}" for entry in session_data.get("history", [])])
             if history_str:
-                context_parts.append(f"## Session History\n{history_str}")
+                # 会话历史始终位于上下文最前面
+                parts[0:0] = ("## Session History\n", history_str, "\n\n")
         else:
             logger.warning(f"无法加载会话 ‘{session_id}’。将继续操作，但不会保留历史记录。")
 
-    if app.company_knowledge_base:
-        context_parts.append(f"## Company-Wide Knowledge Base\n{app.company_knowledge_base}")
-    if product_key: # MODIFIED: 使用product_key
-        product_data = app.products.get(product_key)
-        if product_data:
-            context_parts.append(f"## Knowledge Base for Product: '{product_data.get('product_name')}'\n{product_data.get('knowledge_base','')}")
-    if persona_key: # MODIFIED: 使用persona_key
-        persona_data = app.personas.get(persona_key)
-        if persona_data:
-            profile_text = (f"Role: {persona_data.get('role')}\n"
-                            f"Goals: {', '.join(persona_data.get('goals',[]))}\n"
-                            f"Background: {persona_data.get('background', 'N/A')}")
-            context_parts.append(f"## Persona Profile to Embody: {persona_data.get('name', persona_key)}\n{profile_text}")
-    
-    context_header = "--- CONTEXTUAL BACKGROUND ---\n" + "\n\n".join(context_parts) if context_parts else ""
-    final_prompt = f"{context_header}\n\n--- YOUR CURRENT TASK ---\n{prompt}".strip()
+    if parts:
+        parts.insert(0, "--- CONTEXTUAL BACKGROUND ---\n")
+    parts.append("--- YOUR CURRENT TASK ---\n")
+    parts.append(prompt)
+    final_prompt = "".join(parts).strip()
 
     try:
         logger.info(f"Running team '{team_name}' for session '{session_id or 'None'}'...")
@@ -400,10 +467,10 @@ async def run_ai_team(team_name: str, prompt: str, session_id: Optional[str] = N
             session_data["history"].append({"role": "user", "content": prompt})
             session_data["history"].append({"role": "assistant", "content": content})
             app.session_manager.save_session(session_id, session_data)
-        return json.dumps(response_data, indent=2, ensure_ascii=False)
+        return _dump(response_data)
     except Exception as e:
         logger.exception(f"团队 '{team_name}' 执行错误: {e}")
-        return json.dumps({"error": f"发生了一个意外错误: {str(e)}"})
+        return _dump({"error": f"发生了一个意外错误: {str(e)}"})
 
 
 # ==============================================
@@ -414,9 +481,23 @@ async def app_lifespan(mcp_instance: FastMCP) -> AsyncIterator[None]:
     """管理应用程序的启动和关闭流程."""
     logger.info("服务器正在运行。应用程序上下文已就绪。")
     yield
+    app.session_manager.flush()
     logger.info("服务器正在关闭.")
 
+def _install_event_loop_policy():
+    """在 Linux 上优先使用 uvloop 事件循环；不可用时保持默认策略。"""
+    if sys.platform != "linux":
+        return
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("未安装 uvloop，使用默认 asyncio 事件循环。")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("已启用 uvloop 事件循环。")
+
 def main():
+    _install_event_loop_policy()
     mcp.lifespan = app_lifespan
     logger.info("Unified MCP Server starting...")
     mcp.run(transport="stdio")
@@ -22,17 +22,18 @@ def setup_logger():
     stream_handler.setFormatter(formatter)
     logger.addHandler(stream_handler)
 
-    # 文件 handler
-    file_handler = logging.FileHandler(log_file_path, encoding="utf-8")
+    # 文件 handler：按大小轮转，并经 MemoryHandler 批量写入以减少写系统调用；
+    # 缓冲满 256 条或出现 ERROR 及以上级别日志时才落盘，进程退出时 logging.shutdown 会刷出剩余日志
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file_path, maxBytes=10_000_000, backupCount=3, encoding="utf-8"
+    )
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    buffered_handler = logging.handlers.MemoryHandler(
+        capacity=256, flushLevel=logging.ERROR, target=file_handler
+    )
+    logger.addHandler(buffered_handler)
 
     return logger
 
 # 创建并配置 logger 实例，供其他模块导入
-logger = setup_logger()
-
-# 确保日志立即写入文件
-for handler in logger.handlers:
-    if isinstance(handler, logging.FileHandler):
-        handler.flush()
\ No newline at end of file
+logger = setup_logger()
\ No newline at end of file
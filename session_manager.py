@@ -1,51 +1,171 @@
-import json
+import os
+import atexit
+import re
+import time
 import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
-from typing import Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 # 从我们刚创建的日志模块导入 logger
 from mcp_logger import logger
+import json_codec
+import msgpack
+
+# session_id 只允许 ASCII 字母、数字、'-' 和 '_'，防止路径穿越
+_SESSION_ID_RE = re.compile(r'[A-Za-z0-9_\-]+')
+# 会话文件在最后一次保存后超过该时长即视为过期
+_EXPIRATION_SECONDS = timedelta(hours=24).total_seconds()
+# 两次过期清理之间的最短间隔，避免每次创建会话都扫描整个目录
+_CLEANUP_INTERVAL_SECONDS = 3600
+# 清理过期会话时并发执行 stat/unlink 的线程数
+_CLEANUP_WORKERS = 8
+# 后台写入线程每轮最多处理的会话数
+_WRITE_BATCH_SIZE = 32
+# 会话以 MessagePack 格式存储在按 session_id 前两位划分的子目录中：.msgpack 为除 history 外的会话头，
+# .history 为逐条追加的 history 记录（依次拼接的 MessagePack 对象）。追加只减少磁盘写入量：
+# 每次保存仍需编码整个 history、与已写入的内容做前缀比较，CPU 开销仍与 history 长度成正比（均在 C 层完成）。
+# 旧版本直接写在存储根目录下的 .msgpack / .json 会话，以及内嵌 history 的会话文件，在下次保存时迁移
+_SESSION_SUFFIX = ".msgpack"
+_HISTORY_SUFFIX = ".history"
+_LEGACY_SUFFIX = ".json"
+_SHARD_PREFIX_LEN = 2
+
+def _unpack(buf: Any) -> Any:
+    return msgpack.unpackb(buf, raw=False)
+
+def _pack(obj: Any) -> bytes:
+    return msgpack.packb(obj, use_bin_type=True)
+
+def _read_session_file(path: str) -> Any:
+    """读取并解析会话文件（MessagePack，或旧版本的 JSON）。"""
+    decode = json_codec.loads if path.endswith(_LEGACY_SUFFIX) else _unpack
+    with open(path, 'rb') as f:
+        return decode(f.read())
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _decode_session(header: bytes, log: Optional[bytes]) -> Any:
+    """
+    由会话头与 history 日志的字节还原会话数据。旧格式的会话头内嵌 history，此时忽略日志；
+    写入中断留下的不完整尾部记录会被忽略。
+    """
+    data = _unpack(header)
+    if isinstance(data, dict) and "history" not in data:
+        history = []
+        if log is not None:
+            unpacker = msgpack.Unpacker(raw=False)
+            unpacker.feed(log)
+            history = list(unpacker)
+        data["history"] = history
+    return data
+
+def _log_signature(path: str) -> Tuple[int, int]:
+    """history 日志的 (mtime_ns, size)，文件不存在时为 (0, -1)。"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return (0, -1)
+    return (st.st_mtime_ns, st.st_size)
 
 class SessionManager:
     """负责会话数据的存储、检索和生命周期管理。"""
     def __init__(self, storage_path: Path):
         self.storage_path = storage_path
+        # 热路径上直接使用字符串路径，避免反复构造 Path 对象
+        self._storage_path_str = str(storage_path)
+        self._last_cleanup: Optional[float] = None
+        # 会话文件内容的 LRU 缓存：session_id -> (文件签名, 会话头字节, history 日志字节)，
+        # 签名为会话头与 history 日志的 (mtime_ns, size)。缓存的是编码后的字节，每次命中时重新解析，
+        # 省去的是磁盘读取；后台写入线程也据此判断磁盘上的日志内容，从而只追加新增的记录
+        self._cache: "OrderedDict[str, Tuple[tuple, bytes, Optional[bytes]]]" = OrderedDict()
+        self._cache_max = 256
+        self._cache_lock = threading.Lock()
+        # 等待后台写入的会话：session_id -> (会话头路径, 会话头字节, history 日志字节)。
+        # 编码后的字节即是保存时刻的快照，调用方之后修改会话字典不会影响排队的数据
+        self._pending: Dict[str, Tuple[str, bytes, Optional[bytes]]] = {}
+        self._pending_cond = threading.Condition()
+        # 从旧版文件加载的会话：session_id -> 旧文件路径，保存为新格式后删除旧文件
+        self._legacy_files: Dict[str, str] = {}
+        # 已确认存在的分片子目录，避免每次写入都调用 mkdir
+        self._known_shards: set = set()
         try:
             self.storage_path.mkdir(parents=True, exist_ok=True)
             logger.info(f"会话Session已初始化于: {self.storage_path}")
         except OSError:
             logger.critical(f"重要：无法在以下位置创建会话存储目录： {storage_path}. 请检查是否已经授权访问.", exc_info=True)
             raise
+        threading.Thread(target=self._writer_loop, name="session-writer", daemon=True).start()
+        atexit.register(self.flush)
 
-    def _get_path(self, session_id: str) -> Path:
-        if not all(c.isalnum() or c in '-_' for c in session_id):
+    def _get_path(self, session_id: str) -> str:
+        if not _SESSION_ID_RE.fullmatch(session_id):
             raise ValueError(f"无效的 session_id 格式: {session_id}")
-        return self.storage_path / f"session-{session_id}.json"
+        return f"{self._storage_path_str}{os.sep}{session_id[:_SHARD_PREFIX_LEN]}{os.sep}session-{session_id}{_SESSION_SUFFIX}"
 
-    def _cleanup_old_sessions(self):
-        """清理超过24小时的旧会話文件，或已损坏的文件。"""
+    @staticmethod
+    def _history_path(path: str) -> str:
+        """由会话头路径得到对应的 history 追加日志路径。"""
+        return f"{path[:-len(_SESSION_SUFFIX)]}{_HISTORY_SUFFIX}"
+
+    def _legacy_paths(self, session_id: str) -> Tuple[str, str]:
+        """旧版本未分片时，会话文件在存储根目录下的可能路径。"""
+        return (f"{self._storage_path_str}{os.sep}session-{session_id}{_SESSION_SUFFIX}",
+                f"{self._storage_path_str}{os.sep}session-{session_id}{_LEGACY_SUFFIX}")
+
+    def _iter_session_entries(self) -> Iterator[os.DirEntry]:
+        """遍历存储根目录（旧版本文件）以及各分片子目录中的全部目录项。"""
+        with os.scandir(self._storage_path_str) as root_entries:
+            for entry in root_entries:
+                if entry.is_dir(follow_symlinks=False):
+                    with os.scandir(entry.path) as shard_entries:
+                        yield from shard_entries
+                else:
+                    yield entry
+
+    def _maybe_expire(self, entry: os.DirEntry, now: float, _unlink=os.unlink, _exists=os.path.exists,
+                      _expiration=_EXPIRATION_SECONDS, _suffixes=(_SESSION_SUFFIX, _LEGACY_SUFFIX, _HISTORY_SUFFIX)) -> int:
+        """
+        若目录项是已过期的会话则删除它，返回删除的会话数（0 或 1）。以会话头的 mtime 判断（每次保存都会刷新），
+        history 日志随会话头一起删除；只有找不到会话头的孤立日志才单独按自身的 mtime 判断。
+        清理时会对每个目录项调用一次，常用的全局对象通过默认参数预先绑定。
+        """
+        name = entry.name
+        if not (name.startswith("session-") and name.endswith(_suffixes)):
+            return 0
+        path = entry.path
+        is_log = name.endswith(_HISTORY_SUFFIX)
+        if is_log and _exists(f"{path[:-len(_HISTORY_SUFFIX)]}{_SESSION_SUFFIX}"):
+            return 0
         try:
-            now = datetime.now(timezone.utc)
-            expiration_duration = timedelta(hours=24)
-            cleaned_count = 0
-            for session_file in self.storage_path.glob("session-*.json"):
-                try:
-                    with open(session_file, 'r', encoding='utf-8') as f:
-                        session_data = json.load(f)
-                    
-                    if session_data and "created_at" in session_data:
-                        created_at = datetime.fromisoformat(session_data["created_at"])
-                        if now - created_at > expiration_duration:
-                            session_file.unlink()
-                            cleaned_count += 1
-                    else:
-                        session_file.unlink()
-                        logger.warning(f"删除了一个格式不正确的会话文件: {session_file.name}")
+            if now - entry.stat(follow_symlinks=False).st_mtime <= _expiration:
+                return 0
+            _unlink(path)
+        except FileNotFoundError:
+            # 文件可能已被其他进程删除
+            return 0
+        if not is_log and name.endswith(_SESSION_SUFFIX):
+            try:
+                _unlink(self._history_path(path))
+            except FileNotFoundError:
+                pass
+        return 1
 
-                except (json.JSONDecodeError, IOError, ValueError):
-                    session_file.unlink()
-                    logger.warning(f"删除了一个损坏或无法解析的会话文件: {session_file.name}")
+    def _cleanup_old_sessions(self):
+        """
+        清理超过24小时未被更新的旧会话文件。以文件 mtime（最后一次保存的时间）判断，无需读取文件内容；
+        各文件的 stat/unlink 相互独立，交给线程池并发执行（系统调用期间会释放 GIL）。
+        """
+        try:
+            now = time.time()
+            with ThreadPoolExecutor(max_workers=_CLEANUP_WORKERS) as pool:
+                cleaned_count = sum(pool.map(lambda entry: self._maybe_expire(entry, now), self._iter_session_entries()))
             
             if cleaned_count > 0:
                 logger.info(f"会话清理：删除了 {cleaned_count} 个过期的会话。")
@@ -53,8 +173,10 @@ class SessionManager:
             logger.error(f"会话清理过程中发生严重错误: {e}", exc_info=True)
 
     def create_session(self, initial_context: Optional[str] = None) -> dict:
-        self._cleanup_old_sessions()
-        session_id = str(uuid.uuid4())
+        if self._last_cleanup is None or time.monotonic() - self._last_cleanup > _CLEANUP_INTERVAL_SECONDS:
+            self._cleanup_old_sessions()
+            self._last_cleanup = time.monotonic()
+        session_id = uuid.uuid4().hex
         session_data = {
             "session_id": session_id, "status": "active",
             "created_at": datetime.now(timezone.utc).isoformat(),
@@ -67,23 +189,175 @@ class SessionManager:
         logger.info(f"创建了新会话: {session_id}")
         return session_data
 
+    def _signature(self, path: str, log_path: str) -> Optional[tuple]:
+        """会话头与 history 日志的 (mtime_ns, size)；会话头不存在时返回 None。"""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size) + _log_signature(log_path)
+
+    def _cache_get(self, session_id: str, signature: tuple) -> Optional[Tuple[bytes, Optional[bytes]]]:
+        with self._cache_lock:
+            entry = self._cache.get(session_id)
+            if entry is None or entry[0] != signature:
+                return None
+            self._cache.move_to_end(session_id)
+            return entry[1], entry[2]
+
+    def _cache_put(self, session_id: str, signature: tuple, header: bytes, log: Optional[bytes]):
+        with self._cache_lock:
+            self._cache[session_id] = (signature, header, log)
+            self._cache.move_to_end(session_id)
+            while len(self._cache) > self._cache_max:
+                self._cache.popitem(last=False)
+
+    def _cache_evict(self, session_id: str):
+        with self._cache_lock:
+            self._cache.pop(session_id, None)
+
     def load_session(self, session_id: str) -> Optional[dict]:
+        """
+        加载会话：读取会话头与 history 追加日志并解析。两个文件的 (mtime, size) 均未变化时直接解析缓存的字节，无需读取磁盘。
+        """
         try:
             path = self._get_path(session_id)
-            if not path.exists():
-                logger.warning(f"未找到ID {session_id} 对应的会话文件。")
-                return None
-            with open(path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError, ValueError) as e:
+            with self._pending_cond:
+                pending = self._pending.get(session_id)
+            if pending is not None:
+                return _decode_session(pending[1], pending[2])
+            log_path = self._history_path(path)
+            signature = self._signature(path, log_path)
+            if signature is None:
+                return self._load_legacy_session(session_id)
+            cached = self._cache_get(session_id, signature)
+            if cached is None:
+                cached = (_read_bytes(path), _read_bytes(log_path) if signature[3] >= 0 else None)
+                self._cache_put(session_id, signature, *cached)
+            return _decode_session(*cached)
+        except (json_codec.JSONDecodeError, IOError, ValueError) as e:
             logger.error(f"无法加载或解析会话，ID: {session_id}, 错误信息: {e}", exc_info=True)
             return None
 
+    def _load_legacy_session(self, session_id: str) -> Optional[dict]:
+        """兼容旧版本写入在存储根目录下的会话文件；这些文件不进入缓存，下次保存时迁移为新格式。"""
+        for path in self._legacy_paths(session_id):
+            try:
+                data = _read_session_file(path)
+            except FileNotFoundError:
+                continue
+            self._legacy_files[session_id] = path
+            return data
+        self._cache_evict(session_id)
+        logger.warning(f"未找到ID {session_id} 对应的会话文件。")
+        return None
+
+    def _write_file(self, path: str, payload: bytes):
+        # 先写入临时文件再原子替换，避免读取方或崩溃时看到写了一半的会话文件
+        shard_dir = os.path.dirname(path)
+        if shard_dir not in self._known_shards:
+            os.makedirs(shard_dir, exist_ok=True)
+            self._known_shards.add(shard_dir)
+        tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
     def save_session(self, session_id: str, data: dict):
+        """
+        将会话交给后台写入线程后立即返回。同一会话尚未落盘的多次保存会合并为一次写入，
+        落盘前 load_session 直接返回最新数据。需要确保已写入磁盘时调用 flush()。
+        """
         try:
             path = self._get_path(session_id)
-            with open(path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-        except (IOError, ValueError) as e:
+            header, log = self._encode_session(data)
+        except (IOError, TypeError, ValueError) as e:
             logger.error(f"保存会话ID {session_id} 出错，错误信息: {e}", exc_info=True)
-            raise
\ No newline at end of file
+            raise
+        with self._pending_cond:
+            self._pending[session_id] = (path, header, log)
+            self._pending_cond.notify_all()
+
+    def _encode_session(self, data: dict) -> Tuple[bytes, Optional[bytes]]:
+        """
+        将会话序列化为 MessagePack（需要人工查看时使用 dump_pretty），返回 (会话头字节, history 日志字节)。
+        history 整体只调用一次 packb 编码，再去掉数组头，得到依次拼接的各条记录；history 不是列表时直接内嵌在会话头中。
+        """
+        history = data.get("history")
+        if not isinstance(history, list):
+            return _pack(data), None
+        packed = _pack(history)
+        # MessagePack 数组头：fixarray 1 字节，array16 3 字节，array32 5 字节
+        count = len(history)
+        header_len = 1 if count < 16 else 3 if count < 0x10000 else 5
+        return _pack({k: v for k, v in data.items() if k != "history"}), packed[header_len:]
+
+    def _write_history(self, log_path: str, log: bytes, written: Optional[bytes]):
+        """
+        写入 history 日志。written 为磁盘上现有日志的内容（未知时为 None）；若它是本次内容的字节前缀，只在末尾追加新增的部分，
+        否则（首次写入、记录被修改、日志被外部改动或上次追加中断）原子地整体重写。
+        写入量与新增记录的大小成正比；编码与前缀比较仍覆盖整个 history。
+        """
+        if written is not None and log.startswith(written):
+            if len(log) > len(written):
+                with open(log_path, 'ab') as f:
+                    f.write(memoryview(log)[len(written):])
+            return
+        self._write_file(log_path, log)
+
+    def _writer_loop(self):
+        while True:
+            with self._pending_cond:
+                while not self._pending:
+                    self._pending_cond.wait()
+                batch = list(islice(self._pending.items(), _WRITE_BATCH_SIZE))
+            for session_id, item in batch:
+                path, header, log = item
+                log_path = self._history_path(path)
+                try:
+                    # 签名与缓存一致时，缓存的字节就是磁盘上的现有内容
+                    signature = self._signature(path, log_path)
+                    known = self._cache_get(session_id, signature) if signature is not None else None
+                    # 先写 history 日志再写会话头；会话头未变化时只刷新其 mtime，供过期清理判断
+                    if log is not None:
+                        self._write_history(log_path, log, known[1] if known is not None else None)
+                    if known is not None and known[0] == header:
+                        os.utime(path)
+                    else:
+                        self._write_file(path, header)
+                    signature = self._signature(path, log_path)
+                    if signature is not None:
+                        self._cache_put(session_id, signature, header, log)
+                    legacy_path = self._legacy_files.pop(session_id, None)
+                    if legacy_path is not None:
+                        try:
+                            os.unlink(legacy_path)
+                        except FileNotFoundError:
+                            pass
+                except OSError as e:
+                    logger.error(f"保存会话ID {session_id} 出错，错误信息: {e}", exc_info=True)
+                    self._cache_evict(session_id)
+                with self._pending_cond:
+                    # 写入期间若又有新的保存请求，保留它等待下一轮写入
+                    if self._pending.get(session_id) is item:
+                        del self._pending[session_id]
+                    self._pending_cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """阻塞直到所有排队的会话都已写入磁盘；超时返回 False。"""
+        with self._pending_cond:
+            return self._pending_cond.wait_for(lambda: not self._pending, timeout)
+
+    def dump_pretty(self, session_id: str) -> Optional[str]:
+        """返回缩进格式的会话内容，便于人工查看；会话不存在或无法加载时返回 None。"""
+        session_data = self.load_session(session_id)
+        if session_data is None:
+            return None
+        return json_codec.dumps_pretty(session_data).decode("utf-8")